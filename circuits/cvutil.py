@@ -1,17 +1,21 @@
 #!/usr/bin/env python3
 
+import concurrent.futures
+import functools
 import logging
+import mmap
 import os
 import re
-import operator
 import shlex
 import subprocess
-import time
 import util
 
 # Default values for synthesis
 DEFAULT_MAX_SYNTHESIS_TIME = 20
 
+# Upper bound on concurrent graph generation processes
+MAX_GRAPH_WORKERS = 8
+
 # Exceptions
 
 class TimeoutException (Exception):
@@ -31,6 +35,20 @@ RST_PORT_NAME = 'rst'
 DONTCARE_PORT_NAME = '_DontCare'
 DONTCARE_PREFIX = '_DontCare_'
 
+HIERARCHY_HEADER = b'=== design hierarchy ==='
+
+# Verilog patterns
+MODULE_PATTERN = re.compile(r'module\s+\\?([a-zA-Z_][a-zA-Z_0-9]*)\s*\(')
+
+# Whole-file variant of the module and port patterns, matched line by line
+# over the raw bytes. Whitespace is restricted to [ \t] so that a match never
+# spans more than one line. Groups: module, dir, msb, lsb, port.
+VERILOG_PATTERN = re.compile(
+    rb'(?m)^(?:module[ \t]+\\?([a-zA-Z_][a-zA-Z_0-9]*)[ \t]*\('
+    rb'|[ \t]*(input|output)[ \t]*'
+    rb'(?:\[[ \t]*(\d+)[ \t]*:[ \t]*(\d+)[ \t]*\])?'
+    rb'[ \t]*([a-zA-Z_][a-zA-Z_0-9]*)[ \t]*;)')
+
 NUSMV_KEYWORDS = frozenset([
     "MODULE", "DEFINE", "MDEFINE", "CONSTANTS", "VAR", "IVAR", "FROZENVAR",
     "INIT", "TRANS", "INVAR", "SPEC", "CTLSPEC", "LTLSPEC", "PSLSPEC", "COMPUTE",
@@ -42,6 +60,7 @@ NUSMV_KEYWORDS = frozenset([
     "init", "union", "in", "xor", "xnor", "self", "TRUE", "FALSE", "count"])
 
 
+@functools.lru_cache(maxsize=None)
 def mangle_id(name):
     if name in NUSMV_KEYWORDS:
         return name + "#"
@@ -69,109 +88,158 @@ class Interface:
     def __init__(self, name, ports=None):
         self.name = name
         self.ports = {}
-        self.inputs = []
-        self.outputs = []
+        self.inputs = {}
+        self.outputs = {}
         if ports is not None:
-            for p in ports.itervalues():
+            for p in ports.values():
                 self.add_port(p.name, p.dir, p.width)
 
     def __iter__(self):
         return iter(self.ports)
 
+    def __contains__(self, name):
+        return name in self.ports
+
     def __repr__(self):
         return "%s.%s('%s',%s)" % (self.__class__.__module__, self.__class__.__name__,
                                    self.name, repr(self.ports))
 
     def add_port(self, name, dir, width):
+        if name in self.ports:
+            self.del_port(name)
         p = Port(name, dir, width)
         if dir == 'input':
-            self.inputs.append(p)
+            self.inputs[name] = p
         elif dir == 'output':
-            self.outputs.append(p)
+            self.outputs[name] = p
         self.ports[name] = p
 
     def del_port(self, name):
         p = self.ports[name]
         if p.dir == 'input':
-            self.inputs.remove(p)
+            del self.inputs[name]
         elif p.dir == 'output':
-            self.outputs.remove(p)
+            del self.outputs[name]
         del self.ports[name]
 
 
+def file_signature(path):
+    '''Returns a (path, mtime, size) tuple that changes whenever the file does.'''
+    st = os.stat(path)
+    return (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+
+
+def clear_parse_caches():
+    '''Forgets all the cached parsing results.'''
+    cached_parse_top_module.cache_clear()
+    cached_parse_verilog.cache_clear()
+
+
 def parse_top_module(stdout_path, verilog_path):
     '''Parses a top module using the Yosys output if possible, 
-       otherwise returns the first module name on the verilog file.'''
-    with open(stdout_path, 'r') as file:
-        content = file.read()
+       otherwise returns the first module name on the verilog file.
+       The result is cached while neither file changes.'''
+    return cached_parse_top_module(file_signature(stdout_path),
+                                   file_signature(verilog_path))
 
-    hierarchy_start = content.find("=== design hierarchy ===")
-    if hierarchy_start != -1:
-        hierarchy_content = content[hierarchy_start +
-                                    len("=== design hierarchy ==="):].strip()
-        lines = hierarchy_content.splitlines()
-        for line in lines:
-            if line.strip():
-                return re.split(r'\s+', line.strip())[0]
 
-    module_pattern = re.compile(r'module\s+\\?([a-zA-Z_][a-zA-Z_0-9]*)\s*\(')
+@functools.lru_cache(maxsize=32)
+def cached_parse_top_module(stdout_signature, verilog_signature):
+    stdout_path = stdout_signature[0]
+    verilog_path = verilog_signature[0]
+
+    top_module = find_hierarchy_top(stdout_path)
+    if top_module:
+        return top_module
 
     with open(verilog_path, "r") as file:
         for line in file:
-            m = module_pattern.match(line)
+            if 'module' not in line:
+                continue
+            m = MODULE_PATTERN.match(line)
             if m:
                 return m.group(1)  # module name
 
     return None
 
 
+def find_hierarchy_top(stdout_path):
+    '''Returns the first module listed after the design hierarchy header of
+       a Yosys output file, or None if there is no such header.'''
+    if util.file_empty(stdout_path):
+        return None
+
+    with open(stdout_path, 'rb') as file, \
+            mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        pos = buf.find(HIERARCHY_HEADER)
+        if pos == -1:
+            return None
+
+        pos += len(HIERARCHY_HEADER)
+        while pos < len(buf):
+            end = buf.find(b'\n', pos)
+            if end == -1:
+                end = len(buf)
+            tokens = buf[pos:end].split(None, 1)
+            if tokens:
+                return tokens[0].decode()
+            pos = end + 1
+
+    return None
+
+
 def parse_verilog(path):
-    '''Parses a verilog file and returns a list of its modules.'''
+    '''Parses a verilog file and returns a list of its modules.
+       The result is cached while the file does not change, so it must
+       not be modified by the caller.'''
+    return cached_parse_verilog(file_signature(path))
+
 
-    module_pattern = re.compile(r'module\s+\\?([a-zA-Z_][a-zA-Z_0-9]*)\s*\(')
-    port_pattern = re.compile(
-        r'^\s*(input|output)\s*(\[\s*(\d+)\s*:\s*(\d+)\s*\])?\s*([a-zA-Z_][a-zA-Z_0-9]*)\s*;')
+@functools.lru_cache(maxsize=32)
+def cached_parse_verilog(signature):
+    path = signature[0]
 
     name = None
     ifaces = {}
-    with open(path, "r") as file:
-        for line in file:
-            m = module_pattern.match(line)
-            if m:
-                name = m.group(1)
+    if util.file_empty(path):
+        return ifaces
+
+    with open(path, 'rb') as file, \
+            mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        for m in VERILOG_PATTERN.finditer(buf):
+            module, dir, msb, lsb, port = m.groups()
+            if module:
+                name = module.decode()
                 if not name in ifaces:
                     ifaces[name] = Interface(name)
+                continue
 
-            p = port_pattern.match(line)
-            if p:
-                size = 1  # default size
-                if p.group(2):
-                    msb = int(p.group(3))  # most significant bit
-                    lsb = int(p.group(4))  # least significant bit
-                    size = msb - lsb + 1
+            size = 1  # default size
+            if msb:
+                msb = int(msb)  # most significant bit
+                lsb = int(lsb)  # least significant bit
+                size = msb - lsb + 1
 
-                if not '_DontCare' in p.group(5):
-                    ifaces[name].add_port(name=p.group(
-                        5), dir=p.group(1), width=size)
+            port = port.decode()
+            if not '_DontCare' in port:
+                ifaces[name].add_port(name=port, dir=dir.decode(), width=size)
 
     return ifaces
 
 
 def write_interface(iface, path):
     '''Writes a Interface object to a file.'''
-    f = open(path, 'w')
-    if not f:
-        raise Exception("Cannot create prototype file")
-
-    print('module %s;' % iface.name, file=f)
+    lines = ['module %s;\n' % iface.name]
 
-    # Prototype files are to be sorted by 1) inputs first 2) port name
-    for port in sorted(iface.inputs, key=operator.attrgetter('name')):
-        print('\t%s [%d] %s;' % (port.dir, port.width, port.name), file=f)
-    for port in sorted(iface.outputs, key=operator.attrgetter('name')):
-        print('\t%s [%d] %s;' % (port.dir, port.width, port.name), file=f)
+    # Prototype files are to be sorted by 1) inputs first 2) port name.
+    # Ports are keyed by name, so sorting the plain keys is enough.
+    for ports in (iface.inputs, iface.outputs):
+        for name in sorted(ports):
+            port = ports[name]
+            lines.append('\t%s [%d] %s;\n' % (port.dir, port.width, port.name))
 
-    f.close()
+    with open(path, 'w') as f:
+        f.write(''.join(lines))
 
 
 def parse_solution_interface_and_synth():
@@ -206,27 +274,23 @@ def parse_solution_interface_and_synth():
 
 
 def parse_submission_interface(top_module):
+    '''Parses the submission interfaces. The submission verilog is written by
+       the synthesis script, so synthesis must have been run before.'''
     logging.info('Start of submission interface parsing.')
-    try:
-        execute_with_timeout('yosys', 'driver/yosys/yosys_submission_parser.ys',
-                             stdout="correction/yosys/submission/yosys.stdout")
-        ifaces = parse_verilog("correction/yosys/submission/submission.v")
-        for i in ifaces:
-            write_interface(
-                ifaces[i], "correction/yosys/submission/" + i + ".iface")
+    ifaces = parse_verilog("correction/yosys/submission/submission.v")
+    for i in ifaces:
+        write_interface(
+            ifaces[i], "correction/yosys/submission/" + i + ".iface")
 
-        if not top_module in ifaces:
-            top_module = parse_top_module(
-                "correction/yosys/submission/synthesis.stdout", "correction/yosys/submission/submission.v")
-            if not top_module:
-                raise SubmissionException
+    if not top_module in ifaces:
+        top_module = parse_top_module(
+            "correction/yosys/submission/synthesis.stdout", "correction/yosys/submission/submission.v")
+        if not top_module:
+            raise SubmissionException
 
-        write_interface(ifaces[top_module],
-                        "correction/yosys/submission/top_module.iface")
+    write_interface(ifaces[top_module],
+                    "correction/yosys/submission/top_module.iface")
 
-    except TimeoutError:
-        logging.error('Yosys took too long to parse the file.')
-        return False
     logging.info('End of submission interface parsing.')
     return True
 
@@ -264,10 +328,9 @@ def detect_circuit_traits(iface):
             raise Exception("'%s' port must not be a bus" % DONTCARE_PORT_NAME)
         traits.dont_care = True
 
-    for port in iter(iface.ports):
+    for port, p in iface.ports.items():
         if not port.startswith(DONTCARE_PREFIX):
             continue
-        p = iface.ports[port]
         if p.dir != 'output':
             raise Exception("'%s' must be an output port" % p.name)
         if p.width != 1:
@@ -284,75 +347,97 @@ def detect_circuit_traits(iface):
 
 
 def get_submission_stats_and_graphs():
+    """Generates the svg graph of every module of the submission, running
+       the independent yosys/netlistsvg invocations concurrently."""
     submission_dir = "correction/yosys/submission/"
     statistics_graphs_file = "driver/yosys/statistics_graphs.ys"
     output_dir = "correction/graphs/"
 
     os.makedirs(output_dir, exist_ok=True)
 
-    output_paths = []
+    with os.scandir(submission_dir) as entries:
+        file_names = [entry.name for entry in entries
+                      if entry.name.endswith(".iface") and entry.name != "top_module.iface"]
+    if not file_names:
+        return []
 
-    for file_name in os.listdir(submission_dir):
-        if file_name.endswith(".iface") and file_name != "top_module.iface":
+    with open(statistics_graphs_file, 'r') as file:
+        template = file.read()
 
-            json_file = os.path.join(
-                submission_dir, file_name.replace(".iface", ".json"))
-            svg_file = os.path.join(
-                output_dir, file_name.replace(".iface", ".svg"))
+    workers = min(MAX_GRAPH_WORKERS, os.cpu_count() or 1, len(file_names))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(generate_module_graph, file_names,
+                                    [template] * len(file_names)))
 
-            # Prepare the script file
-            with open(statistics_graphs_file, 'r') as original_file:
-                temp_yosys_script = os.path.join(
-                    submission_dir, file_name + "-statistics_graph.ys")
-                with open(temp_yosys_script, 'w') as temp_file:
-                    for line in original_file:
-                        temp_file.write(line.replace(
-                            "top_module", file_name.replace(".iface", "")))
+    return sorted(path for path in results if path is not None)
 
-            # Execute the script (leaves a .json description of the interface)
-            try:
-                execute_with_timeout(
-                    'yosys', temp_yosys_script,
-                    stdout=os.path.join(submission_dir, "stats.stdout"),
-                    stderr=os.path.join(submission_dir, "stats.stderr")
-                )
-            except TimeoutError:
-                logging.error(
-                    f"Timeout error during processing of {file_name}")
-                continue
 
-            # Generate the SVG file from the JSON output
-            try:
-                os.system('netlistsvg ' + json_file + ' -o ' + svg_file)
-                output_paths.append(svg_file)
-            except Exception as e:
-                logging.error(f"Failed to generate SVG for {json_file}: {e}")
+def generate_module_graph(file_name, template):
+    """Generates the svg graph of the module described by the interface file
+       file_name, using the yosys script template. Returns the path of the svg
+       file, or None on timeout."""
+    submission_dir = "correction/yosys/submission/"
+    output_dir = "correction/graphs/"
+
+    json_file = os.path.join(
+        submission_dir, file_name.replace(".iface", ".json"))
+    svg_file = os.path.join(
+        output_dir, file_name.replace(".iface", ".svg"))
+
+    # Prepare the script file
+    temp_yosys_script = os.path.join(
+        submission_dir, file_name + "-statistics_graph.ys")
+    with open(temp_yosys_script, 'w') as temp_file:
+        temp_file.write(template.replace(
+            "top_module", file_name.replace(".iface", "")))
 
-            os.remove(temp_yosys_script)
+    # Execute the script (leaves a .json description of the interface).
+    # Each module gets its own log files since scripts run concurrently.
+    try:
+        execute_with_timeout(
+            'yosys', temp_yosys_script,
+            stdout=os.path.join(submission_dir, file_name + "-stats.stdout"),
+            stderr=os.path.join(submission_dir, file_name + "-stats.stderr")
+        )
+    except TimeoutError:
+        logging.error(
+            f"Timeout error during processing of {file_name}")
+        return None
 
-    return output_paths
+    # Generate the SVG file from the JSON output
+    try:
+        subprocess.run(['netlistsvg', json_file, '-o', svg_file],
+                       timeout=DEFAULT_MAX_SYNTHESIS_TIME, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except Exception as e:
+        logging.error(f"Failed to generate SVG for {json_file}: {e}")
+        svg_file = None
 
+    os.remove(temp_yosys_script)
 
-def execute_with_timeout(cmd, args, timeout=DEFAULT_MAX_SYNTHESIS_TIME, stdout=None, stderr=None):
-    """Executes the command cmd with arguments args, limiting the execution time."""
+    return svg_file
+
+
+def execute_with_timeout(cmd, args, timeout=DEFAULT_MAX_SYNTHESIS_TIME, stdout=None, stderr=None, cwd=None):
+    """Executes the command cmd with arguments args, limiting the execution time.
+       The command runs in the directory cwd (args are relative to it), while
+       the stdout and stderr paths are relative to the current directory."""
     logging.info("Executing '" + cmd + " " + args + "'")
 
-    if stdout is not None:
-        stdout = open(stdout, 'w')
-    if stderr is not None:
-        stderr = open(stderr, 'w')
-
-    proc = subprocess.Popen([cmd] + shlex.split(args),
-                            stdout=stdout, stderr=stderr, close_fds=True)
-    del stdout
-    del stderr
-
-    c = 0
-    while c <= timeout:
-        if proc.poll() is not None:  # Process has just terminated
-            return proc.returncode
-        time.sleep(0.2)
-        c += 0.2
-
-    proc.kill()
-    raise TimeoutException
+    out = open(stdout, 'w') if stdout is not None else None
+    err = open(stderr, 'w') if stderr is not None else None
+
+    try:
+        with subprocess.Popen([cmd] + shlex.split(args),
+                              stdout=out, stderr=err, close_fds=True, cwd=cwd) as proc:
+            try:
+                return proc.wait(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+                raise TimeoutException
+    finally:
+        if out is not None:
+            out.close()
+        if err is not None:
+            err.close()
@@ -1,5 +1,8 @@
 #!/usr/bin/env python3
 
+import collections
+import concurrent.futures
+import difflib
 import os
 import sys
 import logging
@@ -15,6 +18,7 @@ def judge0():
     global inf
 
     logging.info('Start of judge0()')
+    cvutil.clear_parse_caches()
     create_directory_structure()
 
     logging.info('Writing dummy correction.yml with generic internal error')
@@ -35,10 +39,23 @@ def judge0():
     }
 
     try:
-        inf.hdl = util.read_yml(inf.dir+'/problem/handler.yml')
-        inf.pbm = util.read_yml(inf.dir+'/problem/problem.yml')
-        inf.sub = util.read_yml(inf.dir+'/submission/submission.yml')
-        inf.drv = util.read_yml(inf.dir+'/driver/driver.yml')
+        # The four files are independent, so read them concurrently
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            futures = {
+                'hdl': executor.submit(util.read_yml, inf.dir+'/problem/handler.yml'),
+                'pbm': executor.submit(util.read_yml, inf.dir+'/problem/problem.yml'),
+                'sub': executor.submit(util.read_yml, inf.dir+'/submission/submission.yml'),
+                'drv': executor.submit(util.read_yml, inf.dir+'/driver/driver.yml'),
+            }
+            for key, future in futures.items():
+                setattr(inf, key, future.result())
+
+        # Options are looked up in this order of precedence (an empty file
+        # loads as None and just provides no options)
+        sources = [(inf.sub or {}, 'submission'), (inf.pbm or {}, 'problem'),
+                   (inf.drv or {}, 'driver'), (inf.hdl or {}, 'handler')]
+        inf.cfg = collections.ChainMap(*[src for src, _ in sources])
+        inf.cfg_origin = {opt: whe for src, whe in reversed(sources) for opt in src}
     except IOError:
         logging.error("Error on data structures.")
         logging.error('Writting problem error on correction/compilation2.txt.')
@@ -79,7 +96,6 @@ def judge0():
     try:
         c = synthesis()
         inf.env['time_end'] = util.current_time()
-        util.write_yml(inf.dir+'/correction/correction.yml', inf.cor)
 
         if c:  # Run correction only if synthesis was successful
             logging.info('Start of correction step.')
@@ -141,13 +157,14 @@ def judge0():
 
 
 def synthesis():
-    """Run the synthesizer on the student's file."""
+    """Run the synthesizer on the student's file. The same yosys run also
+       writes the parsed submission verilog used by interface()."""
     global inf
 
     logging.info('Start of synthesis process.')
     try:
         try:
-            cvutil.execute_with_timeout('yosys', 'driver/yosys/yosys_submission_synthesis.ys',
+            cvutil.execute_with_timeout('yosys', 'driver/yosys/yosys_submission_parser_and_synthesis.ys',
                                         stdout="correction/yosys/submission/synthesis.stdout",
                                         stderr="correction/yosys/submission/synthesis.stderr")
         except TimeoutError:
@@ -172,17 +189,19 @@ def interface():
     try:
         cvutil.parse_submission_interface(inf.iface.name)
 
-        # Use diff to stop if any differences are found
-        r = os.system(
-            'diff correction/yosys/solution/top_module.iface correction/yosys/submission/top_module.iface > correction/interface.txt')
-        r = os.WEXITSTATUS(r)
-        if r == 0:  # No differences were found
+        # Interface files are tiny, so compare them in memory
+        solution = util.read_file('correction/yosys/solution/top_module.iface')
+        submission = util.read_file('correction/yosys/submission/top_module.iface')
+        if solution == submission:  # No differences were found
             return True
-        elif r == 1:  # Some differences found
-            inf.cor['veredict'] = 'CE'
-            return False
-        else:
-            raise Exception(util.read_file('interface.txt'))
+
+        # Some differences found
+        diff = difflib.unified_diff(solution.splitlines(keepends=True),
+                                    submission.splitlines(keepends=True),
+                                    'solution', 'submission')
+        util.write_file('correction/interface.txt', ''.join(diff))
+        inf.cor['veredict'] = 'CE'
+        return False
     except cvutil.SubmissionException:
         logging.info(
             'Submission error on interface checking. Unable to locate top module.')
@@ -214,7 +233,7 @@ def verification():
         else:
             inf.cor['veredict'] = 'WA'
             logging.info("Wrong answer, parsing verifier results.")
-            r = verifier.parse_results()
+            r = verifier.parse_results(emit_svg=get('emit_svg', False))
             logging.info("Results trace generated.")
             return False
 
@@ -241,21 +260,15 @@ def collect_statistics_and_graphs():
 
 def get(opt, default=None):
     global inf
-    val = None
-    if opt in inf.sub:
-        val, whe = inf.sub[opt], 'submission'
-    elif opt in inf.pbm:
-        val, whe = inf.pbm[opt], 'problem'
-    elif opt in inf.drv:
-        val, whe = inf.drv[opt], 'driver'
-    elif opt in inf.hdl:
-        val, whe = inf.hdl[opt], 'handler'
+    if opt in inf.cfg:
+        val, whe = inf.cfg[opt], inf.cfg_origin[opt]
     else:
         val, whe = default, 'default'
     if val is None:
         raise Exception('missing option (%s)' % opt)
 
-    logging.info('using value %s for option %s from %s' % (str(val), opt, whe))
+    if logging.getLogger().isEnabledFor(logging.INFO):
+        logging.info('using value %s for option %s from %s' % (str(val), opt, whe))
     return val
 
 
@@ -265,20 +278,22 @@ def move_trace_files():
     logging.info('Start of move_trace_files()')
 
     try:
-        svg_files = [f for f in os.listdir(
-            'correction/traces/') if f.endswith('.svg')]
-        json_files = [f for f in os.listdir(
-            'correction/traces/') if f.endswith('.json')]
-
-        for i, file in enumerate(svg_files, start=1):
-            src_path = os.path.join('correction/traces/', file)
+        svg_files = []
+        json_files = []
+        with os.scandir('correction/traces/') as entries:
+            for entry in entries:
+                if entry.name.endswith('.svg'):
+                    svg_files.append(entry.path)
+                elif entry.name.endswith('.json'):
+                    json_files.append(entry.path)
+
+        for i, src_path in enumerate(svg_files, start=1):
             dest_path = os.path.join('correction/', f"trace{i}.svg")
             util.move_file(src_path, dest_path)
             logging.info('Moving ' + src_path + ' to ' + dest_path + '.')
             inf.cor['trace_files'].append(dest_path)
 
-        for i, file in enumerate(json_files, start=1):
-            src_path = os.path.join('correction/traces/', file)
+        for i, src_path in enumerate(json_files, start=1):
             dest_path = os.path.join('correction/', f"trace{i}.json")
             util.move_file(src_path, dest_path)
             logging.info('Moving ' + src_path + ' to ' + dest_path + '.')
@@ -4,6 +4,7 @@
 # Importations
 ##############################################################################
 
+import copy
 import os
 import time
 import shutil
@@ -14,6 +15,12 @@ import socket
 import yaml
 import getpass
 
+# Use the libyaml bindings when available
+try:
+    from yaml import CSafeLoader as YmlLoader, CSafeDumper as YmlDumper
+except ImportError:
+    from yaml import SafeLoader as YmlLoader, SafeDumper as YmlDumper
+
 
 ##############################################################################
 # Init logging
@@ -51,11 +58,19 @@ def hostname():
 ##############################################################################
 
 
+def atomic_write(name, data):
+    '''Writes the file name with the bytes data. They go to a sibling
+       temporary file first, which is then renamed over name, so readers
+       never see a partially written file.'''
+    tmp = name + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, name)
+
+
 def write_file(name, txt=''):
     '''Writes the file name with contents txt.'''
-    f = open(name, 'w')
-    f.write(txt)
-    f.close()
+    atomic_write(name, txt.encode())
 
 
 def read_file(name):
@@ -98,13 +113,17 @@ def file_empty(name):
 
 
 def copy_file(src, dst):
-    '''Copies a file from src to dst.'''
-    shutil.copy(src, dst)
+    '''Copies the contents of file src to dst, without its permission bits.'''
+    shutil.copyfile(src, dst)
 
 
 def move_file(src, dst):
-    '''Moves a file from src to dst.'''
-    shutil.move(src, dst)
+    '''Moves a file from src to dst. Renames it when both are on the same
+       filesystem, otherwise falls back to a copy.'''
+    try:
+        os.rename(src, dst)
+    except OSError:
+        shutil.move(src, dst)
 
 
 ##############################################################################
@@ -113,16 +132,33 @@ def move_file(src, dst):
 
 
 def print_yml(inf):
-    print(yaml.dump(inf, indent=4, width=1000, default_flow_style=False))
+    print(yaml.dump(inf, Dumper=YmlDumper, indent=4,
+                    width=1000, default_flow_style=False))
 
 
 def write_yml(path, inf):
-    yaml.dump(inf, open(path, "w"), indent=4,
-              width=1000, default_flow_style=False)
+    atomic_write(path, yaml.dump(inf, Dumper=YmlDumper, indent=4, width=1000,
+                                 default_flow_style=False, encoding='utf-8'))
+
+
+# Parsed YAML files, keyed by (path, mtime, size)
+_yml_cache = {}
 
 
 def read_yml(path):
-    return yaml.load(open(path, 'r'), Loader=yaml.FullLoader)
+    '''Returns the contents of the YAML file path. Parsed files are cached
+       until they change; callers get their own copy of the cached data.'''
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+    if key not in _yml_cache:
+        _yml_cache[key] = read_yml_raw(path)
+    return copy.deepcopy(_yml_cache[key])
+
+
+def read_yml_raw(path):
+    '''Parses the YAML file path, bypassing the cache.'''
+    with open(path, 'rb') as f:
+        return yaml.load(f, Loader=YmlLoader)
 
 
 ##############################################################################
@@ -155,11 +191,4 @@ def current_time():
 
 def exc_traceback():
     '''Similar to traceback.print_exc but return a string rather than printing it.'''
-
-    path = tmp_file()
-    f = open(path, 'w')
-    traceback.print_exc(file=f)
-    f.close()
-    r = read_file(path)
-    del_file(path)
-    return r
+    return traceback.format_exc()
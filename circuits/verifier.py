@@ -1,11 +1,14 @@
 #!/usr/bin/env python3
 
+import concurrent.futures
+import functools
 import json
 import logging
+import mmap
 import os
 import re
-import time
 import subprocess
+import time
 import cvutil
 import util
 
@@ -14,6 +17,7 @@ DEFAULT_MAX_VERIFICATION_TIME = 30
 DEFAULT_ENGINE = "smtbmc"
 DEFAULT_SOLVER = "z3"
 DEFAULT_DEPTH = "10"
+DEFAULT_MAX_TRACE_RENDER_TIME = 60
 
 # Accepted engines, solvers, and depth
 # https://yosyshq.readthedocs.io/projects/eqy/en/latest/strategies.html
@@ -25,6 +29,24 @@ ENGINES = {
 MIN_DEPTH = 1
 MAX_DEPTH = 100
 
+# VCD $var and $scope definition lines, matched against the raw bytes of the
+# trace ($upscope and $enddefinitions are fixed literals)
+VCD_VAR_PATTERN = re.compile(
+    rb'\$var wire (?P<width>\d+) (?P<wire>n\d+) (?P<name>\S+) \$end')
+VCD_SCOPE_PATTERN = re.compile(rb'\$scope module (?P<scope>\w+) \$end')
+
+# Buffer size used to stream (possibly very large) VCD traces
+VCD_BUFFER_SIZE = 1 << 20
+
+# Values of the vector changes up to 8 bits wide, the vast majority in a
+# trace, keyed by their VCD text (e.g. b'b0101')
+MAX_TABLED_WIDTH = 8
+SMALL_VALUES = {b'b' + format(i, '0%db' % w).encode(): i
+                for w in range(1, MAX_TABLED_WIDTH + 1) for i in range(1 << w)}
+
+# Port declarations of an interface (.iface) file
+IFACE_PATTERN = re.compile(r'\b(input|output)\s+\[\d+\]\s+(\w+);')
+
 # Exceptions:
 
 
@@ -87,247 +109,264 @@ def execute_verifier(module, timeout=DEFAULT_MAX_VERIFICATION_TIME):
     """Executes Eqy to verify model, redirecting output to stdout and limiting the execution time."""
     logging.info("Start of Yosys-Eqy execution.")
 
-    os.chdir('correction')
+    # eqy runs inside correction/, the driver stays in the job directory
     test_file_path = '../driver/yosys/' + module + '.eqy'
 
     cvutil.execute_with_timeout('eqy', test_file_path,
                                 timeout=timeout,
-                                stdout="yosys/eqy.stdout",
-                                stderr="yosys/eqy.stderr")
+                                stdout="correction/yosys/eqy.stdout",
+                                stderr="correction/yosys/eqy.stderr",
+                                cwd='correction')
 
     logging.info("End of Yosys-Eqy execution.")
 
-    with open('yosys/eqy.stdout', 'r') as file:
-        r = None
-        for line in file:
-            if "Successfully proved designs equivalent" in line:
-                r = True
-            elif "Failed to prove equivalence" in line:
-                r = False
+    # eqy prints its verdict at the end, the last one reported wins
+    stdout_path = 'correction/yosys/eqy.stdout'
+    if util.file_empty(stdout_path):
+        return None
+
+    with open(stdout_path, 'rb') as file, \
+            mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        proved = buf.rfind(b'Successfully proved designs equivalent')
+        failed = buf.rfind(b'Failed to prove equivalence')
+    r = None if proved == failed else proved > failed
 
-    os.chdir('..')
     return r
 
 
-def parse_results():
-    """Parses Value Change Dump (VCD) files and generates """
+def parse_results(emit_svg=False):
+    """Parses Value Change Dump (VCD) files and generates their JSON traces.
+       SVG waveforms are only rendered (with sootty) when emit_svg is set.
+       Traces of different strategies are processed in parallel."""
 
     util.mkdir('correction/traces')
-    path_to_vcd_files = find_vcd_files()
-    for file_path in path_to_vcd_files:
-        print(file_path)
 
-        destination_path, file_name = generate_clean_vcd(file_path)
+    # Traces of the same strategy share their output files, so they are kept
+    # together and processed in order, as done sequentially
+    groups = {}
+    for file_path in find_vcd_files():
+        groups.setdefault(trace_strategy(file_path), []).append(file_path)
+    groups = list(groups.values())
+    if not groups:
+        return True
+
+    workers = min(len(groups), os.cpu_count() or 1)
+    if workers == 1:
+        results = [process_traces(paths, emit_svg) for paths in groups]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(process_traces, groups,
+                                        [emit_svg] * len(groups)))
 
-        svg_filename = "correction/traces/" + file_name + ".svg"
-        json_filename = "correction/traces/" + file_name + ".json"
+    return all(results)
 
-        try:
-            os.system('sootty "' + destination_path + '" -o > ' + svg_filename)
 
-        except Exception as e:
-            logging.debug("Failed creating " + svg_filename + " file.")
-            logging.debug(e)
+def process_traces(paths, emit_svg=False):
+    """Generates the JSON (and optionally SVG) traces of each VCD file in
+       paths, in order. Returns False if some JSON could not be created."""
+    for file_path in paths:
+        print(file_path)
 
-        if (util.file_exists(svg_filename) and not util.file_empty(svg_filename)):
-            logging.debug('File generated: ' + svg_filename)
-        else:
-            util.del_file(svg_filename)
+        file_name = trace_strategy(file_path)
+        svg_filename = "correction/traces/" + file_name + ".svg"
+        json_filename = "correction/traces/" + file_name + ".json"
 
         try:
-            r = generate_json_from_vcd(file_path)
-            if (r):
-                logging.debug('File generated: ' + json_filename)
+            destination_path = process_vcd(file_path, file_name, clean=emit_svg)
+            logging.debug('File generated: ' + json_filename)
 
         except Exception as e:
             logging.debug("Failed creating " + json_filename)
             logging.debug(e)
             return False
 
+        if emit_svg:
+            try:
+                with open(svg_filename, 'wb') as out:
+                    subprocess.run(['sootty', destination_path, '-o'], stdout=out,
+                                   stderr=subprocess.DEVNULL, check=True,
+                                   timeout=DEFAULT_MAX_TRACE_RENDER_TIME)
+
+            except (OSError, subprocess.SubprocessError) as e:
+                # Do not keep the partial output of a failed or hung render
+                logging.debug("Failed creating " + svg_filename + " file.")
+                logging.debug(e)
+                util.del_file(svg_filename)
+
+            if (util.file_exists(svg_filename) and not util.file_empty(svg_filename)):
+                logging.debug('File generated: ' + svg_filename)
+            else:
+                util.del_file(svg_filename)
+
     return True
 
 
 def find_vcd_files():
-    induct_traces = subprocess.run(
-        ["find", "correction/", "-name", "trace_induct.vcd"], capture_output=True, text=True)
-    traces = subprocess.run(
-        ["find", "correction/", "-name", "trace.vcd"], capture_output=True, text=True)
-    result = str.splitlines(induct_traces.stdout.strip()) + \
-        str.splitlines(traces.stdout.strip())
-
-    if result == "":
-        return None
-
-    return result
-
-
-def generate_clean_vcd(file_path):
-    with open(file_path, 'r') as file:
-        lines = file.readlines()
-
-    var_wire_pattern = re.compile(r"\$var wire (\d+) (n\d+) (\S+) \$end")
-    scope_pattern = re.compile(r"\$scope module (\w+) \$end")
-    upscope_pattern = re.compile(r"\$upscope \$end")
-    enddefinitions_pattern = re.compile(r"\$enddefinitions \$end")
-    wires_to_remove = ['t']
-    filtered_lines = []
-    current_module = []
-    inside_definitions = True
-
-    for line in lines:
-        if inside_definitions:
-            if "timescale" in line:
-                filtered_lines.append(line)
-                continue
-
-            var_match = var_wire_pattern.match(line)
-            if var_match:
-                wire_width = var_match.group(1)
-                wire_number = var_match.group(2)
-                wire_name = var_match.group(3)
-
-                if (wire_name == 'okay'):
-                    filtered_lines.append(line)
-                elif ((not current_module) or wire_name.startswith('__') or wire_name.startswith('_DontCare_')
-                        or (current_module[-1] != 'gate' and current_module[-1] != 'gold')):
-                    wires_to_remove.append(wire_number)
-                else:
-                    modified_line = "$var wire " + wire_width + " " + wire_number + \
-                        " " + current_module[-1] + "." + wire_name + " $end\n"
-                    filtered_lines.append(modified_line)
-                continue
-
-            scope_match = scope_pattern.match(line)
-            if scope_match:
-                current_module.append(scope_match.group(1))
-                filtered_lines.append(line)
-
-            elif upscope_pattern.match(line):
-                if current_module:
-                    current_module.pop()
-                filtered_lines.append(line)
-
-            elif enddefinitions_pattern.match(line):
-                inside_definitions = False
-                filtered_lines.append(line)
-
-        else:
-            split_line = line.split(' ')
-            if (len(split_line) == 1):
-                if (split_line[0].startswith('#')):
-                    filtered_lines.append(line)
-            elif (len(split_line) == 2):
-                if (not split_line[1].strip() in wires_to_remove):
-                    filtered_lines.append(line)
-
-    strategy = file_path.split('strategies/')[1].split('/')[0]
-    destination_path = "correction/traces/" + strategy + ".vcd"
-    with open(destination_path, 'w') as file:
-        file.writelines(filtered_lines)
-
-    return destination_path, strategy
-
-
-def generate_json_from_vcd(file_path):
-    # Determine strategy and destination path
-    strategy = file_path.split('strategies/')[1].split('/')[0]
-    destination_path = "correction/traces/" + strategy + ".json"
-
-    # Retrieve the interface names (assumed to return lists of names)
+    """Returns the paths of the trace files left by eqy under correction/,
+       induction traces first."""
+    induct_traces = []
+    traces = []
+    for dir_path, _, file_names in os.walk('correction/'):
+        for file_name in file_names:
+            if file_name == 'trace_induct.vcd':
+                induct_traces.append(os.path.join(dir_path, file_name))
+            elif file_name == 'trace.vcd':
+                traces.append(os.path.join(dir_path, file_name))
+
+    return induct_traces + traces
+
+
+def trace_strategy(file_path):
+    """Returns the name of the eqy strategy that produced the trace file_path."""
+    parts = file_path.split(os.sep)
+    return parts[parts.index('strategies') + 1]
+
+
+def process_vcd(file_path, strategy, clean=True):
+    """Parses the trace file_path of the given eqy strategy in a single pass,
+       writing its JSON trace and, if clean is set, a cleaned VCD (only
+       gold/gate interface wires) to be rendered. Returns the path of the
+       cleaned VCD, or None."""
+    # Determine destination paths
+    vcd_path = "correction/traces/" + strategy + ".vcd"
+    json_path = "correction/traces/" + strategy + ".json"
+
+    # Retrieve the interface names
     input_names, output_names = parse_iface(
-        'correction/yosys/submission/' + str(strategy).split('.')[0] + '.iface')
-
-    with open(file_path, 'r') as file:
-        lines = file.readlines()
+        'correction/yosys/submission/' + strategy.partition('.')[0] + '.iface')
 
-    # Regular expressions for parsing the VCD file
-    var_wire_pattern = re.compile(r"\$var wire (\d+) (n\d+) (\S+) \$end")
-    scope_pattern = re.compile(r"\$scope module (\w+) \$end")
-    upscope_pattern = re.compile(r"\$upscope \$end")
-    enddefinitions_pattern = re.compile(r"\$enddefinitions \$end")
+    # Interface ports by their name in the trace, as (is input, name) pairs
+    # (a name declared both ways counts as an input)
+    iface_ports = {name.encode(): (False, name) for name in output_names}
+    iface_ports.update({name.encode(): (True, name) for name in input_names})
 
+    wires_to_remove = {b't'}
     current_module = []
-    inside_definitions = True
 
     # Dictionaries to map wire numbers to signal names
     input_wires = {}
     output_gold_wires = {}
     output_gate_wires = {}
 
-    # Dictionary to track signal values over time (by wire number)
-    signal_values = {}
-
-    timestamps = []
+    # Dictionary to track the changes of interface signals as (timestamp
+    # index, value) pairs (by wire number)
+    signal_changes = {}
+
+    num_timestamps = 0
+
+    # Stream the trace, writing each kept line of the cleaned VCD as soon as
+    # it is seen (to the null device when it is not wanted)
+    with open(file_path, 'rb', buffering=VCD_BUFFER_SIZE) as src, \
+            open(vcd_path if clean else os.devnull, 'wb',
+                 buffering=VCD_BUFFER_SIZE) as dst:
+        # Bound once, these are called for every line of the trace
+        match_var = VCD_VAR_PATTERN.match
+        match_scope = VCD_SCOPE_PATTERN.match
+        write = dst.write
+        small_value = SMALL_VALUES.get
+
+        # Definitions section, up to $enddefinitions
+        for line in src:
+            if b"timescale" in line:
+                write(line)
+                continue
 
-    # Process the file line by line
-    for line in lines:
-        if inside_definitions:
-            var_match = var_wire_pattern.match(line)
-            if var_match:
-                wire_number = var_match.group(2)
-                wire_name = var_match.group(3)
+            # Dispatch on the line prefix so that only $var and $scope
+            # lines go through a regular expression
+            if line.startswith(b'$var '):
+                m = match_var(line)
+                if not m:
+                    continue
+
+                wire_width = m.group('width')
+                wire_number = m.group('wire')
+                wire_name = m.group('name')
+
+                if (wire_name == b'okay'):
+                    write(line)
+                elif ((not current_module) or wire_name.startswith(b'__') or wire_name.startswith(b'_DontCare_')
+                        or (current_module[-1] != b'gate' and current_module[-1] != b'gold')):
+                    wires_to_remove.add(wire_number)
+                else:
+                    modified_line = b"$var wire " + wire_width + b" " + wire_number + \
+                        b" " + current_module[-1] + b"." + wire_name + b" $end\n"
+                    write(modified_line)
 
                 # Depending on the current module, assign the wire if it is part of the interface.
-                if current_module and current_module[-1] == 'gold':
-                    if wire_name in input_names:
-                        input_wires[wire_number] = wire_name
-                    elif wire_name in output_names:
-                        output_gold_wires[wire_number] = wire_name
-                elif current_module and current_module[-1] == 'gate':
-                    if wire_name in input_names:
-                        input_wires[wire_number] = wire_name
-                    elif wire_name in output_names:
-                        output_gate_wires[wire_number] = wire_name
-
-                # Initialize tracking for this wire
-                signal_values[wire_number] = []
-                continue
+                # Only those wires have their value changes tracked.
+                scope = current_module[-1] if current_module else None
+                if scope == b'gold' or scope == b'gate':
+                    port = iface_ports.get(wire_name)
+                    if port is not None:
+                        is_input, name = port
+                        if is_input:
+                            input_wires[wire_number] = name
+                        elif scope == b'gold':
+                            output_gold_wires[wire_number] = name
+                        else:
+                            output_gate_wires[wire_number] = name
+                        signal_changes[wire_number] = []
 
-            scope_match = scope_pattern.match(line)
-            if scope_match:
-                current_module.append(scope_match.group(1))
-            elif upscope_pattern.match(line):
+            elif line.startswith(b'$scope '):
+                m = match_scope(line)
+                if m:
+                    current_module.append(m.group('scope'))
+                    write(line)
+
+            elif line.startswith(b'$upscope $end'):
                 if current_module:
                     current_module.pop()
-            elif enddefinitions_pattern.match(line):
-                inside_definitions = False
-        else:
+                write(line)
+
+            elif line.startswith(b'$enddefinitions $end'):
+                write(line)
+                break
+
+        # Value change section, continuing from the same position
+        for line in src:
+            kind = line[0:1]
+
             # If timestamp marker (e.g. "#0", "#5",...)
-            if line.startswith('#'):
-                timestamps.append(int(line[1:]))
-
-                # Extend the signals' list with the previous value
-                for wire in signal_values:
-                    if len(signal_values[wire]) < len(timestamps):
-                        prev = signal_values[wire][-1] if signal_values[wire] else -1
-                        signal_values[wire].append(prev)
-            else:
-                # Process value-change lines (format "b<value> <wire_number>")
-                parts = line.split()
-                if len(parts) == 2:
-                    wire_val = parts[0].strip()
-                    wire_number = parts[1].strip()
-                    # convert binary string to integer
-                    value = int(wire_val[1:], 2)
-
-                    # Update the last value for this wire
-                    if wire_number in signal_values:
-                        if signal_values[wire_number]:
-                            signal_values[wire_number][-1] = value
-                        else:
-                            # Initializes if no previous value
-                            signal_values[wire_number].append(value)
+            if kind == b'#':
+                num_timestamps += 1
+                write(line)
+
+            # Process value-change lines (format "b<value> <wire_number>")
+            elif kind == b'b':
+                wire_val, _, wire_number = line.partition(b' ')
+                wire_number = wire_number.rstrip()
+                if wire_number:
+                    if wire_number not in wires_to_remove:
+                        write(line)
+
+                    # Record the value for the current timestamp of this
+                    # wire, if it is an interface one
+                    changes = signal_changes.get(wire_number)
+                    if changes is not None:
+                        # convert binary string to integer
+                        value = small_value(wire_val)
+                        if value is None:
+                            value = int(wire_val[1:], 2)
+                        changes.append((max(num_timestamps - 1, 0), value))
+
+    # Determine circuit type. Combinational circuits only report the values
+    # at the first timestamp, so there is no need to expand the rest.
+    sequential = "clk" in input_wires.values()
+
+    def values(wire):
+        changes = signal_changes[wire]
+        # The last timestamp marks the end of the trace and is dropped
+        length = (num_timestamps if num_timestamps else len(changes[:1])) - 1
+        if not sequential:
+            length = min(length, 1)
+        return expand_changes(changes, length)
 
     # Build dictionaries mapping signal names to their arrays of values
-    input_values = {input_wires[w]: signal_values[w][:-1]
-                    for w in input_wires if w in signal_values}
-    output_gold_values = {output_gold_wires[w]: signal_values[w][:-1]
-                          for w in output_gold_wires if w in signal_values}
-    output_gate_values = {output_gate_wires[w]: signal_values[w][:-1]
-                          for w in output_gate_wires if w in signal_values}
-
-    # Determine circuit type
-    if "clk" in list(input_values.keys()):
+    input_values = {name: values(w) for w, name in input_wires.items()}
+    output_gold_values = {name: values(w) for w, name in output_gold_wires.items()}
+    output_gate_values = {name: values(w) for w, name in output_gate_wires.items()}
+
+    if sequential:
         circuit_type = "sequential"
     else:
         circuit_type = "combinational"
@@ -350,31 +389,56 @@ def generate_json_from_vcd(file_path):
         "errors": differing_signals
     }
 
-    with open(destination_path, 'w') as file:
+    with open(json_path, 'w') as file:
         json.dump(data, file, indent=2)
 
-    return True
+    return vcd_path if clean else None
+
+
+def expand_changes(changes, length):
+    """Expands a list of (timestamp index, value) changes, in timestamp order,
+       into the list of the values at the first length timestamps. Later
+       changes at the same index override earlier ones, and each timestamp
+       keeps the previous value when there is no change (-1 initially)."""
+    values = []
+    for index, value in changes:
+        if index >= length:
+            break
+        if index == len(values) - 1:
+            values[-1] = value
+        else:
+            prev = values[-1] if values else -1
+            values.extend([prev] * (index - len(values)))
+            values.append(value)
+
+    prev = values[-1] if values else -1
+    values.extend([prev] * (length - len(values)))
+    return values
 
 
 def parse_iface(file_path):
+    """Returns the frozensets of input and output names of the interface file
+       file_path. The result is cached while the file does not change."""
+    return cached_parse_iface(cvutil.file_signature(file_path))
+
+
+@functools.lru_cache(maxsize=32)
+def cached_parse_iface(signature):
+    file_path = signature[0]
+
     input_list = []
     output_list = []
+    append = {'input': input_list.append, 'output': output_list.append}
+    search = IFACE_PATTERN.search
 
     with open(file_path) as file:
-        lines = file.readlines()
-
-    io_pattern = r'\b(input|output)\s+\[\d+\]\s+(\w+);'
-
-    for line in lines:
-        match = re.search(io_pattern, line)
-        if match:
-            io_type, name = match.groups()
-            if (io_type == "input"):
-                input_list.append(name)
-            elif (io_type == "output"):
-                output_list.append(name)
+        for line in file:
+            match = search(line)
+            if match:
+                io_type, name = match.groups()
+                append[io_type](name)
 
-    return input_list, output_list
+    return frozenset(input_list), frozenset(output_list)
 
 # if __name__ == '__main__':
 #     parse_results()